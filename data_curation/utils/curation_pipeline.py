@@ -0,0 +1,377 @@
+import json
+from pathlib import Path
+
+import pandas
+from tqdm.auto import tqdm
+from wiki_dump_extractor import WikiAvroDumpExtractor, WikiXmlDumpExtractor
+
+from .date_index import build_date_index
+from .db_utils import (
+    LMDBReader,
+    LMDBWriter,
+    SqliteTableBatchWriter,
+    anti_join_lmdb,
+    open_sqlite_db,
+)
+from .diagnostics import DiagnosticsSink
+from .event_processing import LLMEventProcessor, process_infobox_event
+from .extraction_utils import find_dates_in_pages, find_links_in_pages, parse_infoboxes
+from .link_index import build_link_index
+from .pipeline import Pipeline
+from .title_dictionary import TitleDictionary, build_title_dictionary
+
+
+def extract_dump_to_avro(xml_dump_path, avro_dump_path, redirects_db):
+    if xml_dump_path is None:
+        raise ValueError("The XML dump is needed to extract the Avro dump")
+    extractor = WikiXmlDumpExtractor(file_path=xml_dump_path)
+    extractor.extract_pages_to_avro(
+        output_file=avro_dump_path,
+        redirects_db_path=redirects_db,
+        batch_size=10_000,
+        ignored_fields=["timestamp", "page_id", "revision_id", "redirect_title"],
+    )
+
+
+def index_pages(avro_dump_path, page_index_db):
+    WikiAvroDumpExtractor(avro_dump_path).index_pages(index_dir=page_index_db)
+
+
+def extract_disambiguation_page_titles(avro_dump_path, target):
+    WikiAvroDumpExtractor(avro_dump_path).extract_disambiguation_page_titles(target)
+
+
+def process_pages_to_lmdb(
+    avro_dump_path,
+    page_index_db,
+    target_db,
+    process_fn,
+    batch_size=10_000,
+    num_workers=6,
+    map_size=20_000_000_000,
+):
+    """Write the (title, value) records returned by process_fn for each batch
+    of pages of the dump to an LMDB store."""
+    dump = WikiAvroDumpExtractor(avro_dump_path, index_dir=page_index_db)
+    processed_batches = dump.process_page_batches_in_parallel(
+        process_fn=process_fn, batch_size=batch_size, num_workers=num_workers
+    )
+    with LMDBWriter(target_db, map_size=map_size) as db:
+        for batch_result in tqdm(processed_batches, desc=Path(target_db).name):
+            if isinstance(batch_result, dict):
+                batch_result = batch_result.items()
+            db.write_batch(
+                (key.encode() if isinstance(key, str) else key, value)
+                for key, value in batch_result
+            )
+
+
+def write_locations_by_page_title(places_csv, redirects_db, target_db):
+    """Write the location of each geotagged page (and of the redirects to these
+    pages) to an LMDB store, from the places CSV of geodata_curation.ipynb."""
+    df = pandas.read_csv(places_csv)
+    page_titles = set(df.page_title)
+    with LMDBWriter(target_db) as db:
+        db.write_batch(
+            (
+                row.page_title.encode(),
+                json.dumps(
+                    {
+                        "geohash4": row.geohash4,
+                        "name": row.name,
+                        "page_title": row.page_title,
+                    }
+                ).encode(),
+            )
+            for row in df.itertuples()
+        )
+        redirects_batch = []
+        with LMDBReader(redirects_db) as redirects:
+            for page_title, redirect_page_title in tqdm(redirects):
+                if redirect_page_title.decode() in page_titles:
+                    location_data = db.get(redirect_page_title)
+                    redirects_batch.append((page_title.encode(), location_data))
+        db.write_batch(redirects_batch)
+
+
+def write_events_to_sql(
+    page_index_db,
+    redirects_db,
+    disambiguation_path,
+    locations_by_title_db,
+    link_index_db,
+    title_dictionary_dir,
+    llm_events_db,
+    infobox_events_db,
+    events_sqlite,
+    raw_computed_views_sqlite,
+    llm_diagnostics_path,
+    infobox_diagnostics_path,
+):
+    """Write the LLM events, then the infobox events of the pages without LLM
+    events, to the events table and the raw computed views (as in
+    events_to_sql.ipynb)."""
+    events_db = open_sqlite_db(events_sqlite, replace=True)
+    raw_computed_views_db = open_sqlite_db(raw_computed_views_sqlite, replace=True)
+    raw_events_by_month_and_region_writer = SqliteTableBatchWriter(
+        db=raw_computed_views_db,
+        table="events_by_month_and_region",
+        index_key="month_region",
+        batch_size=10_000,
+    )
+    raw_page_and_year_writer = SqliteTableBatchWriter(
+        raw_computed_views_db, "events_by_page_and_year", "page_id", batch_size=10_000
+    )
+    event_sql_writer = SqliteTableBatchWriter(
+        events_db, "events", "event_id", batch_size=10_000, assign_rowids=True
+    )
+    event_sql_writer.execute(
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            event_id TEXT PRIMARY KEY,
+            page_title TEXT,
+            page_section TEXT,
+            summary TEXT,
+            location TEXT,
+            'when' TEXT,
+            'where' TEXT,
+            start_date TEXT,
+            end_date TEXT,
+            category TEXT,
+            people TEXT,
+            geohash4 TEXT,
+            where_page_title TEXT,
+            where_is_guess BOOLEAN,
+            city_page_title TEXT,
+            city_is_guess BOOLEAN
+        );
+        """
+    )
+    raw_page_and_year_writer.execute(
+        """CREATE TABLE IF NOT EXISTS events_by_page_and_year (
+            page_id INTEGER,
+            year INTEGER,
+            event_rowid INTEGER
+        );
+        """
+    )
+    raw_page_and_year_writer.execute(
+        """CREATE TABLE IF NOT EXISTS events_by_month_and_region (
+            month_region TEXT,
+            event_rowid INTEGER,
+            geohash4 TEXT
+        );
+        """
+    )
+    writers = dict(
+        raw_events_by_month_and_region_writer=raw_events_by_month_and_region_writer,
+        raw_page_and_year_writer=raw_page_and_year_writer,
+        event_sql_writer=event_sql_writer,
+    )
+    title_dictionary = TitleDictionary(title_dictionary_dir)
+    with open(disambiguation_path, "r") as f:
+        disambiguation_dict = json.load(f)
+
+    with (
+        LMDBReader(redirects_db) as redirects,
+        LMDBReader(page_index_db) as page_index,
+        LMDBReader(locations_by_title_db) as locations_by_title,
+        LMDBReader(link_index_db) as link_index,
+        LMDBReader(llm_events_db) as llm_events,
+        DiagnosticsSink(llm_diagnostics_path) as diagnostics,
+    ):
+        event_processor = LLMEventProcessor(
+            page_index_db=page_index,
+            redirects_db=redirects,
+            disambiguation_dict=disambiguation_dict,
+            link_index_db=link_index,
+            locations_by_title_db=locations_by_title,
+            title_dictionary=title_dictionary,
+        )
+        for page_title, events in tqdm(llm_events, desc="LLM events"):
+            diagnostics.increment("pages")
+            page_events = json.loads(events.decode())
+            diagnostics.increment("total_events", len(page_events))
+            event_processor.process_events_in_page(
+                page_title=page_title,
+                page_events=page_events,
+                diagnostics=diagnostics,
+                **writers,
+            )
+
+    with (
+        LMDBReader(infobox_events_db) as infobox_events,
+        LMDBReader(llm_events_db) as llm_events,
+        DiagnosticsSink(infobox_diagnostics_path) as diagnostics,
+    ):
+        for _, events in tqdm(
+            anti_join_lmdb(infobox_events, llm_events), desc="Infobox events"
+        ):
+            for event_data in json.loads(events.decode()):
+                process_infobox_event(
+                    event_data=event_data,
+                    diagnostics=diagnostics,
+                    title_dictionary=title_dictionary,
+                    **writers,
+                )
+
+    event_sql_writer.insert_records()
+    for writer in [raw_page_and_year_writer, raw_events_by_month_and_region_writer]:
+        writer.insert_records()
+        writer.index()
+
+
+def build_curation_pipeline(
+    wiki_data_dir, generated_data_dir, xml_dump_path=None, n_cores=None, num_workers=6
+):
+    """Return the pipeline of the curation stages, from the dump to the events
+    tables.
+
+    ``xml_dump_path`` is only needed if the Avro dump hasn't been extracted
+    yet. ``num_workers`` is the number of processes of each stage reading the
+    whole dump (and the number of cores the stage counts for).
+
+    Some steps stay in the notebooks, and their outputs are inputs of the
+    pipeline: geodata_curation.ipynb downloads the geo tags and GeoNames dumps
+    and its filters are tuned by inspecting the places
+    (filtered_raw_places_with_geohashes.csv), and the events extracted by the
+    LLM (submit_pages_to_gemini.ipynb, identify_section_and_string.ipynb) and
+    from the infoboxes (extract_events_from_infoboxes.ipynb) cost API calls or
+    manual review. A change in these outputs reruns the downstream stages.
+    """
+    wiki_data_dir, generated_data_dir = Path(wiki_data_dir), Path(generated_data_dir)
+    avro_dump_path = wiki_data_dir / "wiki_dump.avro"
+    redirects_db = wiki_data_dir / "wiki_dump_redirects_db"
+    page_index_db = wiki_data_dir / "wiki_dump_index_db"
+    page_links_db = generated_data_dir / "page_links_db"
+    dates_by_page_db = generated_data_dir / "dates_by_page_db"
+
+    pipeline = Pipeline(generated_data_dir / "pipeline_state.json", n_cores=n_cores)
+    pipeline.add_stage(
+        "extract_dump_to_avro",
+        extract_dump_to_avro,
+        outputs=[avro_dump_path, redirects_db],
+        kwargs=dict(
+            xml_dump_path=xml_dump_path,
+            avro_dump_path=avro_dump_path,
+            redirects_db=redirects_db,
+        ),
+        # The XML dump is only read if the Avro dump is missing (it may have
+        # been deleted since), and rebuilding the Avro dump takes hours.
+        only_if_missing=True,
+    )
+    pipeline.add_stage(
+        "index_pages",
+        index_pages,
+        inputs=[avro_dump_path],
+        outputs=[page_index_db],
+        kwargs=dict(avro_dump_path=avro_dump_path, page_index_db=page_index_db),
+    )
+    title_dictionary_dir = wiki_data_dir / "title_dictionary"
+    pipeline.add_stage(
+        "title_dictionary",
+        build_title_dictionary,
+        inputs=[page_index_db, redirects_db],
+        outputs=[title_dictionary_dir],
+        kwargs=dict(
+            page_index_db=page_index_db,
+            redirects_db=redirects_db,
+            target_dir=title_dictionary_dir,
+        ),
+    )
+    disambiguation_path = wiki_data_dir / "disambiguation_page_titles.json"
+    pipeline.add_stage(
+        "disambiguation_pages",
+        extract_disambiguation_page_titles,
+        inputs=[avro_dump_path],
+        outputs=[disambiguation_path],
+        kwargs=dict(avro_dump_path=avro_dump_path, target=disambiguation_path),
+    )
+    for name, process_fn, target_db in [
+        ("page_links", find_links_in_pages, page_links_db),
+        ("infoboxes", parse_infoboxes, generated_data_dir / "parsed_infoboxes_db"),
+        ("dates", find_dates_in_pages, dates_by_page_db),
+    ]:
+        pipeline.add_stage(
+            name,
+            process_pages_to_lmdb,
+            inputs=[avro_dump_path, page_index_db],
+            outputs=[target_db],
+            kwargs=dict(
+                avro_dump_path=avro_dump_path,
+                page_index_db=page_index_db,
+                target_db=target_db,
+                process_fn=process_fn,
+                num_workers=num_workers,
+            ),
+            n_cores=num_workers,
+        )
+    link_index_db = generated_data_dir / "link_index_db"
+    pipeline.add_stage(
+        "link_index",
+        build_link_index,
+        inputs=[page_links_db],
+        outputs=[link_index_db],
+        kwargs=dict(page_links_db=page_links_db, target_db=link_index_db),
+    )
+    dates_by_page_index = generated_data_dir / "dates_by_page_index"
+    pipeline.add_stage(
+        "date_index",
+        build_date_index,
+        inputs=[dates_by_page_db],
+        outputs=[dates_by_page_index],
+        kwargs=dict(dates_by_page_db=dates_by_page_db, target_dir=dates_by_page_index),
+    )
+    places_csv = generated_data_dir / "filtered_raw_places_with_geohashes.csv"
+    locations_by_title_db = generated_data_dir / "locations_by_page_title_db"
+    pipeline.add_stage(
+        "locations_by_page_title",
+        write_locations_by_page_title,
+        inputs=[places_csv, redirects_db],
+        outputs=[locations_by_title_db],
+        kwargs=dict(
+            places_csv=places_csv,
+            redirects_db=redirects_db,
+            target_db=locations_by_title_db,
+        ),
+    )
+    llm_events_db = (
+        generated_data_dir / "events_extracted_by_page_gemini-2.0_processed_db"
+    )
+    infobox_events_db = generated_data_dir / "events_extracted_from_infoboxes_db"
+    sql_dir = generated_data_dir / "sql"
+    events_to_sql_outputs = dict(
+        events_sqlite=sql_dir / "events.sqlite",
+        raw_computed_views_sqlite=sql_dir / "raw_computed_views_db.sqlite",
+        llm_diagnostics_path=generated_data_dir / "llm_events_diagnostics.jsonl.gz",
+        infobox_diagnostics_path=(
+            generated_data_dir / "infobox_events_diagnostics.jsonl.gz"
+        ),
+    )
+    pipeline.add_stage(
+        "events_to_sql",
+        write_events_to_sql,
+        inputs=[
+            page_index_db,
+            redirects_db,
+            disambiguation_path,
+            locations_by_title_db,
+            link_index_db,
+            title_dictionary_dir,
+            llm_events_db,
+            infobox_events_db,
+        ],
+        outputs=list(events_to_sql_outputs.values()),
+        kwargs=dict(
+            page_index_db=page_index_db,
+            redirects_db=redirects_db,
+            disambiguation_path=disambiguation_path,
+            locations_by_title_db=locations_by_title_db,
+            link_index_db=link_index_db,
+            title_dictionary_dir=title_dictionary_dir,
+            llm_events_db=llm_events_db,
+            infobox_events_db=infobox_events_db,
+            **events_to_sql_outputs,
+        ),
+    )
+    return pipeline
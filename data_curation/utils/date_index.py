@@ -0,0 +1,192 @@
+import json
+import zlib
+from array import array
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .db_utils import LMDBReader
+from .title_dictionary import SortedStrings, write_sorted_strings
+
+
+def is_valid_year(date, year_min=-20_000, year_max=2030):
+    """Same filtering as in the original extract_dates notebook: years 1-100
+    are only counted when explicitly written "AD" as they are most often not
+    years at all."""
+    year = date["date"]["year"]
+    if year == 0:
+        return False
+    if 0 < year <= 100 and ("AD" not in date["date_str"]):
+        return False
+    return year_min < year < year_max
+
+
+def build_date_index(dates_by_page_db, target_dir, year_min=-20_000, year_max=2030):
+    """Decode the whole dates store once and write the index to target_dir:
+    the page titles (the position of a title is its page ID), the years of
+    each page and the sorted page IDs of each year, as numpy arrays."""
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+
+    page_offsets = array("q", [0])
+    page_years = array("h")
+    page_year_counts = array("I")
+
+    def iter_titles():
+        with LMDBReader(dates_by_page_db) as db:
+            for page, zipped_dates in tqdm(db, desc="Indexing dates"):
+                dates = json.loads(zlib.decompress(zipped_dates).decode("utf-8"))
+                counts = Counter(
+                    d["date"]["year"]
+                    for d in dates
+                    if is_valid_year(d, year_min=year_min, year_max=year_max)
+                )
+                for year in sorted(counts):
+                    page_years.append(year)
+                    page_year_counts.append(counts[year])
+                page_offsets.append(len(page_years))
+                yield page
+
+    write_sorted_strings(iter_titles(), target_dir, "title")
+
+    page_offsets = np.frombuffer(page_offsets, dtype=np.int64)
+    page_years = np.frombuffer(page_years, dtype=np.int16)
+    page_year_counts = np.frombuffer(page_year_counts, dtype=np.uint32)
+    np.save(target_dir / "page_offsets.npy", page_offsets)
+    np.save(target_dir / "page_years.npy", page_years)
+    np.save(target_dir / "page_year_counts.npy", page_year_counts)
+
+    # Transpose the page -> years table into a year -> pages table. The sort is
+    # stable so the page IDs of each year remain sorted.
+    page_ids = np.repeat(
+        np.arange(len(page_offsets) - 1, dtype=np.uint32), np.diff(page_offsets)
+    )
+    order = np.argsort(page_years, kind="stable")
+    years, year_sizes = np.unique(page_years[order], return_counts=True)
+    year_offsets = np.concatenate([[0], np.cumsum(year_sizes)]).astype(np.int64)
+    np.save(target_dir / "years.npy", years)
+    np.save(target_dir / "year_offsets.npy", year_offsets)
+    np.save(target_dir / "year_pages.npy", page_ids[order])
+    np.save(target_dir / "year_page_counts.npy", page_year_counts[order])
+    return PagesDateIndex(target_dir)
+
+
+class PagesDateIndex:
+    """Memory-mapped view of an index written by ``build_date_index``.
+
+    Page masks returned by the queries are boolean arrays of length
+    ``n_pages``, which can be combined with ``&``, ``|`` and ``~``.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+
+        def load(name):
+            return np.load(self.index_dir / f"{name}.npy", mmap_mode="r")
+
+        self._titles = SortedStrings(self.index_dir, "title")
+        self.page_offsets = load("page_offsets")
+        self.page_years = load("page_years")
+        self.page_year_counts = load("page_year_counts")
+        self.years = load("years")
+        self.year_offsets = load("year_offsets")
+        self.year_pages = load("year_pages")
+        self.year_page_counts = load("year_page_counts")
+        self.n_pages = len(self.page_offsets) - 1
+
+    def title(self, page_id):
+        return self._titles[page_id]
+
+    def titles(self, mask):
+        """Return the titles of the pages selected by a page mask."""
+        return [self._titles[page_id] for page_id in np.flatnonzero(mask)]
+
+    def page_id(self, title):
+        """Return the ID of a page title, or None."""
+        return self._titles.index(title)
+
+    def titles_mask(self, titles):
+        """Return the page mask of a set of titles (unknown titles are ignored)."""
+        mask = np.zeros(self.n_pages, dtype=bool)
+        for title in titles:
+            page_id = self.page_id(title)
+            if page_id is not None:
+                mask[page_id] = True
+        return mask
+
+    def years_of_page(self, title):
+        """Return a dict {year: number_of_dates} for the given page."""
+        page_id = self.page_id(title)
+        if page_id is None:
+            return {}
+        start, end = self.page_offsets[page_id], self.page_offsets[page_id + 1]
+        years = self.page_years[start:end].tolist()
+        return dict(zip(years, self.page_year_counts[start:end].tolist()))
+
+    def _years_slice(self, year_start=None, year_end=None):
+        """Return the slice of ``year_pages`` covering [year_start, year_end]."""
+        first = 0 if year_start is None else np.searchsorted(self.years, year_start)
+        last = (
+            len(self.years)
+            if year_end is None
+            else np.searchsorted(self.years, year_end, side="right")
+        )
+        return slice(self.year_offsets[first], self.year_offsets[last])
+
+    def count_dates_by_page(self, year_start=None, year_end=None):
+        """Return, for each page ID, the number of dates in [year_start, year_end]."""
+        selection = self._years_slice(year_start, year_end)
+        return np.bincount(
+            self.year_pages[selection],
+            weights=self.year_page_counts[selection],
+            minlength=self.n_pages,
+        ).astype(np.uint32)
+
+    def pages_mask(self, year_start=None, year_end=None, min_dates=1, among=None):
+        """Return the mask of the pages with at least ``min_dates`` dates in
+        [year_start, year_end] (bounds are inclusive, None means unbounded).
+
+        ``among`` is an optional page mask (see ``titles_mask``) restricting the
+        selection to a set of pages.
+        """
+        if min_dates <= 1:
+            mask = np.zeros(self.n_pages, dtype=bool)
+            mask[self.year_pages[self._years_slice(year_start, year_end)]] = True
+        else:
+            mask = self.count_dates_by_page(year_start, year_end) >= min_dates
+        if among is not None:
+            mask &= among
+        return mask
+
+    def n_pages_until_years(self, years, year_start=None):
+        """Return the number of pages mentioning at least one date before (or
+        on) each of the given years, i.e. the number of pages to parse to cover
+        all the dates until year X. Dates before year_start are ignored."""
+        years = np.sort(np.asarray(years))
+        seen = np.zeros(self.n_pages, dtype=bool)
+        n_seen = 0
+        results = []
+        year_index = 0
+        if year_start is not None:
+            year_index = np.searchsorted(self.years, year_start)
+        for year in years:
+            last = np.searchsorted(self.years, year, side="right")
+            if last > year_index:
+                new_pages = self.year_pages[
+                    self.year_offsets[year_index] : self.year_offsets[last]
+                ]
+                new_pages = np.unique(new_pages[~seen[new_pages]])
+                seen[new_pages] = True
+                n_seen += len(new_pages)
+                year_index = last
+            results.append(n_seen)
+        return np.array(results)
+
+    def date_counts_by_year(self):
+        """Return a dict {year: total number of dates found for that year}."""
+        totals = np.add.reduceat(
+            self.year_page_counts.astype(np.int64), self.year_offsets[:-1]
+        )
+        return dict(zip(self.years.tolist(), totals.tolist()))
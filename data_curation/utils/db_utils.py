@@ -1,5 +1,9 @@
+import json
 import os
 import shutil
+import time
+import zlib
+from contextlib import ExitStack
 from pathlib import Path
 from sqlalchemy import (
     Table,
@@ -12,6 +16,7 @@ from sqlalchemy import (
     text,
     create_engine,
 )
+import numpy
 import pandas
 
 import fastavro
@@ -20,9 +25,19 @@ from tqdm.auto import tqdm
 import lmdb
 
 
-def sqlite_to_pandas(db_path, table_name):
-    engine = create_engine(f"sqlite:///{db_path}")
-    return pandas.read_sql_table(table_name, engine)
+def sqlite_to_pandas(db_path, table_name, columns=None):
+    if columns is None:
+        engine = create_engine(f"sqlite:///{db_path}")
+        return pandas.read_sql_table(table_name, engine)
+    batches = iter_sqlite_batches(db_path, table_name, columns=columns)
+    return _batches_to_pandas(batches, columns)
+
+
+def _batches_to_pandas(batches, columns):
+    dataframes = [pandas.DataFrame(batch) for batch in batches]
+    if not dataframes:
+        return pandas.DataFrame(columns=columns)
+    return pandas.concat(dataframes, ignore_index=True)
 
 
 class LMDBReader:
@@ -47,11 +62,87 @@ class LMDBReader:
             for key, value in txn.cursor():
                 yield key.decode(), value
 
+    def iter_keys(self):
+        with self.db.begin() as txn:
+            for key in txn.cursor().iternext(keys=True, values=False):
+                yield key.decode()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.db is not None:
             self.db.close()
 
 
+def merge_join_lmdb(*readers):
+    """Yield (key, [value_1, value_2, ...]) for the keys present in all the
+    given LMDB readers.
+
+    LMDB stores are sorted by key, so the cursors advance in lockstep, each
+    one jumping directly (``set_range``) to the largest key seen so far. This
+    is much faster than looking up every key of one store in the others.
+    """
+    with ExitStack() as stack:
+        cursors = [stack.enter_context(r.db.begin()).cursor() for r in readers]
+        if not all(cursor.first() for cursor in cursors):
+            return
+        while True:
+            max_key = cursors[0].key()
+            is_aligned = False
+            while not is_aligned:
+                is_aligned = True
+                for cursor in cursors:
+                    key = cursor.key()
+                    if key < max_key:
+                        # Keys are often close: try the next key before seeking.
+                        if not cursor.next():
+                            return
+                        key = cursor.key()
+                        if key < max_key:
+                            if not cursor.set_range(max_key):
+                                return
+                            key = cursor.key()
+                    if key > max_key:
+                        max_key = key
+                        is_aligned = False
+            yield max_key.decode(), [cursor.value() for cursor in cursors]
+            if not all(cursor.next() for cursor in cursors):
+                return
+
+
+def anti_join_lmdb(left, right):
+    """Yield the (key, value) pairs of the left LMDB reader whose key is not
+    in the right LMDB reader, advancing both cursors in lockstep."""
+    with left.db.begin() as left_txn, right.db.begin() as right_txn:
+        right_cursor = right_txn.cursor()
+        has_right = right_cursor.first()
+        for key, value in left_txn.cursor():
+            if has_right and right_cursor.key() < key:
+                has_right = right_cursor.set_range(key)
+            if not has_right or right_cursor.key() != key:
+                yield key.decode(), value
+
+
+def diff_lmdb(left, right):
+    """Yield (key, left_value, right_value) for the keys whose value differs
+    between the two LMDB readers. The value is None where the key is missing."""
+    with left.db.begin() as left_txn, right.db.begin() as right_txn:
+        left_cursor, right_cursor = left_txn.cursor(), right_txn.cursor()
+        has_left, has_right = left_cursor.first(), right_cursor.first()
+        while has_left or has_right:
+            left_key = left_cursor.key() if has_left else None
+            right_key = right_cursor.key() if has_right else None
+            if has_left and (not has_right or left_key < right_key):
+                yield left_key.decode(), left_cursor.value(), None
+                has_left = left_cursor.next()
+            elif has_right and (not has_left or right_key < left_key):
+                yield right_key.decode(), None, right_cursor.value()
+                has_right = right_cursor.next()
+            else:
+                left_value, right_value = left_cursor.value(), right_cursor.value()
+                if left_value != right_value:
+                    yield left_key.decode(), left_value, right_value
+                has_left, has_right = left_cursor.next(), right_cursor.next()
+
+
 class LMDBWriter(LMDBReader):
     def __init__(self, db_path, map_size=30_000_000_000):
         self.db_path = db_path
@@ -86,11 +177,73 @@ def open_sqlite_db(db_path, replace=False):
     return create_engine(f"sqlite:///{db_path}")
 
 
-def iterate_over_sqlite_table(db_path, table_name):
-    db = create_engine(f"sqlite:///{db_path}")
-    with db.begin() as conn:
-        for record in conn.execute(text(f"SELECT * FROM {table_name}")):
-            yield record._asdict()
+def iterate_over_sqlite_table(db_path, table_name, columns=None, chunk_size=10_000):
+    """Yield the rows of a table as dicts (only the given columns if any).
+
+    ``db_path`` can also be an open sqlite3 connection, which is reused.
+    """
+    chunks = _iter_sqlite_rows(db_path, table_name, columns, chunk_size)
+    for rows, column_names in chunks:
+        for row in rows:
+            yield dict(zip(column_names, row))
+
+
+def _quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _iter_sqlite_rows(db_or_conn, table_name, columns=None, chunk_size=100_000):
+    """Yield (rows, column_names) chunks of at most chunk_size rows."""
+    if isinstance(db_or_conn, sqlite3.Connection):
+        conn, owns_connection = db_or_conn, False
+    else:
+        conn, owns_connection = sqlite3.connect(db_or_conn), True
+    try:
+        # Quoted, as some columns (e.g. "when", "where") are SQL keywords.
+        if columns is None:
+            selected = "*"
+        else:
+            selected = ", ".join(_quote_identifier(column) for column in columns)
+        table = _quote_identifier(table_name)
+        cursor = conn.execute(f"SELECT {selected} FROM {table}")
+        column_names = [description[0] for description in cursor.description]
+        while rows := cursor.fetchmany(chunk_size):
+            yield rows, column_names
+    finally:
+        if owns_connection:
+            conn.close()
+
+
+def _to_batch(column_names, column_values, as_arrow):
+    if as_arrow:
+        import pyarrow
+
+        return pyarrow.RecordBatch.from_pydict(dict(zip(column_names, column_values)))
+    return {
+        name: _to_numpy(values) for name, values in zip(column_names, column_values)
+    }
+
+
+def _to_numpy(values):
+    # Strings are kept as objects: a fixed-width unicode array would be as wide
+    # as the longest string for every row.
+    if all(isinstance(v, (int, float)) for v in values):
+        return numpy.array(values)
+    return numpy.array(values, dtype=object)
+
+
+def iter_sqlite_batches(
+    db_path, table_name, columns=None, chunk_size=100_000, as_arrow=False
+):
+    """Yield the table in chunks of at most chunk_size rows.
+
+    Each chunk is a dict {column: numpy array}, or a pyarrow RecordBatch if
+    ``as_arrow`` is True. Only the given columns are read. ``db_path`` can
+    also be an open sqlite3 connection, which is reused.
+    """
+    chunks = _iter_sqlite_rows(db_path, table_name, columns, chunk_size)
+    for rows, column_names in chunks:
+        yield _to_batch(column_names, list(zip(*rows)), as_arrow)
 
 
 def avro_file(path, replace=False):
@@ -144,6 +297,7 @@ class SqliteTableBatchWriter:
         unloading_threshold=None,
         unloading_dir=None,
         online_filedir=None,
+        assign_rowids=False,
     ):
         self.db = db
         self.table = table
@@ -153,6 +307,8 @@ class SqliteTableBatchWriter:
         self.current_records = []
         self.unloading_threshold = unloading_threshold
         self.online_filedir = online_filedir
+        self.assign_rowids = assign_rowids
+        self.last_rowid = None
         if unloading_dir is not None:
             self.unloading_dir = Path(unloading_dir)
             self.unloading_dir.mkdir(parents=True, exist_ok=True)
@@ -160,6 +316,13 @@ class SqliteTableBatchWriter:
             self.unloading_dir = None
 
     def add_record_to_db_table(self, record):
+        """Add a record to the current batch. If the writer was created with
+        ``assign_rowids=True``, the record is given the next rowid of the
+        table, which is returned so that other tables can refer to it."""
+        rowid = None
+        if self.assign_rowids:
+            rowid = self.next_rowid()
+            record = {"rowid": rowid, **record}
         if self.unloading_threshold is not None:
             unloaded_record = self.unload_large_values(record)
             self.current_records.append(unloaded_record)
@@ -167,6 +330,14 @@ class SqliteTableBatchWriter:
             self.current_records.append(record)
         if len(self.current_records) > self.batch_size:
             self.insert_records()
+        return rowid
+
+    def next_rowid(self):
+        if self.last_rowid is None:
+            result = self.execute(f"SELECT MAX(rowid) FROM {self.table}")
+            self.last_rowid = result.scalar() or 0
+        self.last_rowid += 1
+        return self.last_rowid
 
     def unload_large_values(self, record):
         record = record.copy()
@@ -244,10 +415,43 @@ def db_execute(db, commands):
     return result
 
 
-def avro_to_pandas(avro_file):
+def avro_to_pandas(avro_file, columns=None):
+    if columns is None:
+        with open(avro_file, "rb") as f:
+            records = fastavro.reader(f)
+            return pandas.DataFrame(records)
+    return _batches_to_pandas(iter_avro_batches(avro_file, columns), columns)
+
+
+def iter_avro_batches(avro_file, columns=None, chunk_size=100_000, as_arrow=False):
+    """Yield the records of an Avro file in chunks of at most chunk_size rows.
+
+    Each chunk is a dict {column: numpy array}, or a pyarrow RecordBatch if
+    ``as_arrow`` is True. When columns are given, the file is read with a
+    reader schema projected on these columns, so the other fields are skipped
+    rather than decoded.
+    """
     with open(avro_file, "rb") as f:
-        records = fastavro.reader(f)
-        return pandas.DataFrame(records)
+        reader = fastavro.reader(f)
+        if columns is not None:
+            schema = reader.writer_schema
+            fields = {field["name"]: field for field in schema["fields"]}
+            projected_schema = {**schema, "fields": [fields[c] for c in columns]}
+            f.seek(0)
+            reader = fastavro.reader(f, reader_schema=projected_schema)
+        column_names = columns or [f["name"] for f in reader.writer_schema["fields"]]
+        column_values = [[] for _ in column_names]
+        n_rows = 0
+        for record in reader:
+            for values, name in zip(column_values, column_names):
+                values.append(record[name])
+            n_rows += 1
+            if n_rows == chunk_size:
+                yield _to_batch(column_names, column_values, as_arrow)
+                column_values = [[] for _ in column_names]
+                n_rows = 0
+        if n_rows:
+            yield _to_batch(column_names, column_values, as_arrow)
 
 
 def format_value(v):
@@ -511,3 +715,248 @@ def export_sql_files(
 
     conn.close()
     return files
+
+
+# Columnar blobs
+# --------------
+#
+# Compact alternative to the zlib-compressed JSON blobs of the
+# events_by_month_region and pages tables. A blob is a 5-bytes header (the
+# "LNC" magic, the format version, the blob kind) followed by a zlib-compressed
+# body made of columns of unsigned LEB128 varints (signed values are zigzag
+# encoded) and string tables:
+#
+# - string table: the strings are sorted and each one is stored as the length
+#   of the prefix it shares with the previous string and the rest of its utf-8
+#   bytes ("front coding"). The table is the number of strings, then the
+#   column of shared lengths, the column of rest lengths and the rest bytes.
+# - dates "YYYY[ BC][/MM[/DD]]" are packed as year * 512 + month * 32 + day
+#   (month and day are 0 when absent).
+#
+# Month-region blob (kind 1), a list of {month_region, event_id, geohash4,
+# start_date, end_date} dicts: the month_region string, the event IDs string
+# table, the geohashes string table, the number of events, then the columns:
+# event ID index, geohash index, start date (delta with the previous event's),
+# end date (delta with the event's start date).
+#
+# Page blob (kind 2), a dict {year: [event IDs]}: the event IDs string table,
+# the number of years, then for each year: the year (delta with the previous
+# year), the number of events, and the event ID indices (delta-coded).
+
+COLUMNAR_MAGIC = b"LNC"
+COLUMNAR_VERSION = 1
+MONTH_REGION_BLOB = 1
+PAGE_BLOB = 2
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_signed(out, value):
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _write_string(out, string):
+    encoded = string.encode()
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _write_string_table(out, strings):
+    """Write the sorted strings and return a dict {string: index}."""
+    strings = sorted(set(strings))
+    shared_lengths, suffixes = [], []
+    previous = b""
+    for string in strings:
+        encoded = string.encode()
+        shared = 0
+        max_shared = min(len(encoded), len(previous))
+        while shared < max_shared and encoded[shared] == previous[shared]:
+            shared += 1
+        shared_lengths.append(shared)
+        suffixes.append(encoded[shared:])
+        previous = encoded
+    _write_varint(out, len(strings))
+    for shared in shared_lengths:
+        _write_varint(out, shared)
+    for suffix in suffixes:
+        _write_varint(out, len(suffix))
+    for suffix in suffixes:
+        out += suffix
+    return {string: i for i, string in enumerate(strings)}
+
+
+def pack_date(date_string):
+    """Pack a date string such as "1944/06/06" or "0300 BC/01" in an integer."""
+    year, _, rest = date_string.partition("/")
+    year = -int(year[:-3]) if year.endswith(" BC") else int(year)
+    month, _, day = rest.partition("/")
+    return year * 512 + int(month or 0) * 32 + int(day or 0)
+
+
+def unpack_date(packed):
+    year, month_day = divmod(packed, 512)
+    month, day = divmod(month_day, 32)
+    result = f"{-year:04d} BC" if year < 0 else f"{year:04d}"
+    if month:
+        result += f"/{month:02d}"
+        if day:
+            result += f"/{day:02d}"
+    return result
+
+
+def _columnar_blob(kind, body):
+    return COLUMNAR_MAGIC + bytes([COLUMNAR_VERSION, kind]) + zlib.compress(body)
+
+
+def encode_month_region_events(events):
+    """Encode the events of an events_by_month_region blob (which all have the
+    same month_region)."""
+    out = bytearray()
+    _write_string(out, events[0]["month_region"] if events else "")
+    event_ids = _write_string_table(out, [e["event_id"] for e in events])
+    geohashes = _write_string_table(out, [e["geohash4"] for e in events])
+    _write_varint(out, len(events))
+    for event in events:
+        _write_varint(out, event_ids[event["event_id"]])
+    for event in events:
+        _write_varint(out, geohashes[event["geohash4"]])
+    previous_start = 0
+    for event in events:
+        start = pack_date(event["start_date"])
+        _write_signed(out, start - previous_start)
+        previous_start = start
+    for event in events:
+        duration = pack_date(event["end_date"]) - pack_date(event["start_date"])
+        _write_signed(out, duration)
+    return _columnar_blob(MONTH_REGION_BLOB, out)
+
+
+def encode_page_events_by_year(events_by_year):
+    """Encode the {year: [event IDs]} dict of a pages blob."""
+    out = bytearray()
+    event_ids = _write_string_table(
+        out, [event_id for ids in events_by_year.values() for event_id in ids]
+    )
+    _write_varint(out, len(events_by_year))
+    previous_year = 0
+    for year, ids in events_by_year.items():
+        _write_signed(out, int(year) - previous_year)
+        previous_year = int(year)
+        _write_varint(out, len(ids))
+        previous_index = 0
+        for event_id in ids:
+            _write_signed(out, event_ids[event_id] - previous_index)
+            previous_index = event_ids[event_id]
+    return _columnar_blob(PAGE_BLOB, out)
+
+
+class _ColumnarReader:
+    """Reference decoder of the columnar blobs, written to be easy to port to
+    javascript (a DataView over the inflated body and a position)."""
+
+    def __init__(self, body):
+        self.body = body
+        self.position = 0
+
+    def varint(self):
+        result, shift = 0, 0
+        while True:
+            byte = self.body[self.position]
+            self.position += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def signed(self):
+        value = self.varint()
+        return (value >> 1) if value % 2 == 0 else -((value + 1) >> 1)
+
+    def string(self):
+        length = self.varint()
+        start, self.position = self.position, self.position + length
+        return self.body[start : self.position].decode()
+
+    def string_table(self):
+        n_strings = self.varint()
+        shared_lengths = [self.varint() for _ in range(n_strings)]
+        suffix_lengths = [self.varint() for _ in range(n_strings)]
+        strings = []
+        previous = b""
+        for shared, length in zip(shared_lengths, suffix_lengths):
+            start, self.position = self.position, self.position + length
+            previous = previous[:shared] + self.body[start : self.position]
+            strings.append(previous.decode())
+        return strings
+
+
+def decode_columnar_blob(blob):
+    """Decode a columnar blob to the same data as the JSON blob it replaces:
+    a list of event dicts (month-region blobs) or a {year: [event IDs]} dict
+    with string keys (page blobs)."""
+    if blob[:3] != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar blob")
+    version, kind = blob[3], blob[4]
+    if version != COLUMNAR_VERSION:
+        raise ValueError(f"Unsupported columnar blob version: {version}")
+    reader = _ColumnarReader(zlib.decompress(blob[5:]))
+    if kind == MONTH_REGION_BLOB:
+        month_region = reader.string()
+        event_ids = reader.string_table()
+        geohashes = reader.string_table()
+        n_events = reader.varint()
+        event_id_column = [event_ids[reader.varint()] for _ in range(n_events)]
+        geohash_column = [geohashes[reader.varint()] for _ in range(n_events)]
+        start_column, start = [], 0
+        for _ in range(n_events):
+            start += reader.signed()
+            start_column.append(start)
+        end_column = [start + reader.signed() for start in start_column]
+        return [
+            {
+                "month_region": month_region,
+                "event_id": event_id_column[i],
+                "geohash4": geohash_column[i],
+                "start_date": unpack_date(start_column[i]),
+                "end_date": unpack_date(end_column[i]),
+            }
+            for i in range(n_events)
+        ]
+    if kind == PAGE_BLOB:
+        event_ids = reader.string_table()
+        events_by_year, year = {}, 0
+        for _ in range(reader.varint()):
+            year += reader.signed()
+            ids, index = [], 0
+            for _ in range(reader.varint()):
+                index += reader.signed()
+                ids.append(event_ids[index])
+            events_by_year[str(year)] = ids
+        return events_by_year
+    raise ValueError(f"Unknown columnar blob kind: {kind}")
+
+
+def compare_blob_encodings(zlib_json_blobs, encode_fn, n_decodes=3):
+    """Compare the size and decode time of zlib JSON blobs and of their
+    columnar re-encoding (``encode_fn(data) -> blob``)."""
+    blobs = list(zlib_json_blobs)
+    columnar_blobs = [encode_fn(json.loads(zlib.decompress(b))) for b in blobs]
+    results = {}
+    for name, encoded, decode in [
+        ("zlib_json", blobs, lambda b: json.loads(zlib.decompress(b))),
+        ("columnar", columnar_blobs, decode_columnar_blob),
+    ]:
+        start_time = time.perf_counter()
+        for _ in range(n_decodes):
+            for blob in encoded:
+                decode(blob)
+        results[name] = {
+            "total_bytes": sum(len(b) for b in encoded),
+            "decode_seconds": (time.perf_counter() - start_time) / n_decodes,
+        }
+    return results
@@ -0,0 +1,118 @@
+import gzip
+import json
+from collections import Counter
+
+
+class HeavyHitters:
+    """Misra-Gries sketch of the most frequent items of a stream.
+
+    Holds at most ``capacity`` counters. The count of any item is
+    underestimated by at most ``total / (capacity + 1)``, so all items more
+    frequent than that are guaranteed to be in the sketch. Sketches are
+    mergeable: merging two sketches gives the same guarantee on the union of
+    the streams.
+    """
+
+    def __init__(self, capacity=10_000, counters=None):
+        self.capacity = capacity
+        self.counters = Counter(counters or {})
+
+    def add(self, item, count=1):
+        if item in self.counters or len(self.counters) < self.capacity:
+            self.counters[item] += count
+            return
+        # Sketch is full: decrement all counters (and the new item) by the
+        # smallest count, dropping the counters which reach 0.
+        decrement = min(count, min(self.counters.values()))
+        self.counters = Counter(
+            {key: c - decrement for key, c in self.counters.items() if c > decrement}
+        )
+        if count > decrement:
+            self.counters[item] = count - decrement
+
+    def merge(self, other):
+        counters = self.counters + Counter(other.counters)
+        if len(counters) > self.capacity:
+            # Subtract the (capacity + 1)-th largest count to stay in capacity.
+            threshold = sorted(counters.values(), reverse=True)[self.capacity]
+            counters = Counter(
+                {key: c - threshold for key, c in counters.items() if c > threshold}
+            )
+        self.counters = counters
+
+    def top(self, k=50):
+        return self.counters.most_common(k)
+
+
+class DiagnosticsSink:
+    """Stream the failures of a processing run to a gzipped JSONL file,
+    keeping only counters and the most frequent unresolved places in memory."""
+
+    def __init__(self, path, heavy_hitters_capacity=10_000):
+        self.path = path
+        self.counts = Counter()
+        self.unresolved_places = HeavyHitters(capacity=heavy_hitters_capacity)
+        self.failure_files = [str(path)]
+        self.file = None
+
+    def __enter__(self):
+        self.file = gzip.open(self.path, "wt")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def increment(self, name, count=1):
+        self.counts[name] += count
+
+    def record_failure(self, kind, **details):
+        """Count a failure of the given kind and write it to the failures file."""
+        self.counts[kind] += 1
+        self.file.write(json.dumps({"kind": kind, **details}, separators=(",", ":")))
+        self.file.write("\n")
+
+    def record_unresolved_place(self, place):
+        place = place.strip()
+        if place:
+            self.unresolved_places.add(place)
+
+    def top_unresolved_places(self, k=50):
+        return self.unresolved_places.top(k)
+
+    def state(self):
+        return {
+            "counts": dict(self.counts),
+            "unresolved_places": dict(self.unresolved_places.counters),
+            "failure_files": list(self.failure_files),
+        }
+
+    def merge(self, other):
+        """Merge another sink (or the ``state()`` of a sink) into this one."""
+        if isinstance(other, DiagnosticsSink):
+            other = other.state()
+        self.counts.update(other["counts"])
+        self.unresolved_places.merge(
+            HeavyHitters(counters=other["unresolved_places"])
+        )
+        self.failure_files += [
+            f for f in other["failure_files"] if f not in self.failure_files
+        ]
+
+    def summary(self, k=50):
+        return {
+            "counts": dict(self.counts),
+            "top_unresolved_places": self.top_unresolved_places(k),
+        }
+
+
+def iter_failures(diagnostics, kind=None):
+    """Iterate over the failures written by a sink (and the sinks merged into
+    it), optionally only those of a given kind."""
+    for path in diagnostics.failure_files:
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                failure = json.loads(line)
+                if kind is None or failure["kind"] == kind:
+                    yield failure
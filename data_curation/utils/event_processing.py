@@ -1,9 +1,11 @@
 import json
 from functools import lru_cache
-import zlib
+from typing import NamedTuple
 
 from wiki_dump_extractor import date_utils
 
+from .link_index import PageLinks
+
 
 class LLMEventProcessor:
     def __init__(
@@ -12,13 +14,15 @@ class LLMEventProcessor:
         redirects_db,
         disambiguation_dict,
         locations_by_title_db,
-        page_links_db,
+        link_index_db,
+        title_dictionary,
     ):
         self.page_index_db = page_index_db
         self.redirects_db = redirects_db
         self.disambiguation_dict = disambiguation_dict
         self.locations_by_title_db = locations_by_title_db
-        self.page_links_db = page_links_db
+        self.link_index_db = link_index_db
+        self.title_dictionary = title_dictionary
 
     def get_redirect(self, title):
         result = self.redirects_db.get(title.encode())
@@ -58,7 +62,7 @@ class LLMEventProcessor:
             return None, None
 
         if page_links is not None:
-            maybe_link = page_links.get(string.encode())
+            maybe_link = page_links.get(string)
             if maybe_link and (maybe_link != string):
                 if isinstance(maybe_link, list) and len(set(maybe_link)) == 1:
                     maybe_link = maybe_link[0]
@@ -145,14 +149,15 @@ class LLMEventProcessor:
         raw_events_by_month_and_region_writer,
         raw_page_and_year_writer,
         event_sql_writer,
-        date_errors,
-        no_location,
-        counts,
+        diagnostics,
         maybe_page_title_location,
         page_links,
+        resolved_whens=None,
     ):
         if event["when"].lower() in ["unknown", "n/a", "yyyy", "none"]:
             return
+        if resolved_whens is None:
+            resolved_whens = resolve_whens([event["when"]])
         event_data = {
             "event_id": f"{page_title.replace(' ', '_')}_{event_index:03d}",
             "page_title": page_title,
@@ -163,13 +168,14 @@ class LLMEventProcessor:
         where, city = event["where"], event["city"]
         event_data["location"] = where if (city in where) else f"{where}, {city}"
 
-        try:
-            date_range = date_utils.DateRange.from_parsed_string(event["when"])
-            event_data["start_date"] = date_range.start.to_string()
-            event_data["end_date"] = date_range.end.to_string()
-        except Exception as e:
-            date_errors.append((event["when"], str(e)))
+        dates = resolved_whens[normalize_when(event["when"])]
+        if isinstance(dates, DateError):
+            diagnostics.record_failure(
+                "date_error", page=page_title, when=event["when"], error=dates.message
+            )
             return
+        event_data["start_date"] = dates.start_date
+        event_data["end_date"] = dates.end_date
         event_data["category"] = self.attribute_category(event["what"])
 
         event_data["people"] = [
@@ -182,8 +188,14 @@ class LLMEventProcessor:
 
         if where_geolocation == (None, None) and city_geolocation == (None, None):
             if maybe_page_title_location == (None, None):
-                no_location.append("where: " + event["where"])
-                no_location.append("city: " + event["city"])
+                diagnostics.record_failure(
+                    "no_location",
+                    page=page_title,
+                    where=event["where"],
+                    city=event["city"],
+                )
+                diagnostics.record_unresolved_place(event["where"])
+                diagnostics.record_unresolved_place(event["city"])
                 return
             else:
                 where_geolocation = maybe_page_title_location
@@ -213,60 +225,52 @@ class LLMEventProcessor:
         else:
             geolocations = city_geolocation
 
-        counts["events_with_location"] += 1
+        diagnostics.increment("events_with_location")
+
+        people = event_data["people"]
+        event_data["people"] = "|".join(people)
+        event_data["geohash4"] = "|".join([g["geohash4"] for g, _ in geolocations])
 
-        years_range = list(range(date_range.start.year, date_range.end.year + 1))
-        year_months = date_range_to_year_months(date_range)
+        # The raw tables refer to the event by its rowid in the events table
+        # and to pages by their ID in the title dictionary.
+        event_rowid = event_sql_writer.add_record_to_db_table(event_data)
 
-        for year, month in year_months:
+        for year, month in dates.year_months:
             for g, _ in geolocations:
                 if g is None:
                     continue
                 record = {
                     "month_region": f"{year}-{month if month is not None else ''}-{g['geohash4'][0]}",
-                    "event_id": event_data["event_id"],
+                    "event_rowid": event_rowid,
                     "geohash4": g["geohash4"],
-                    "start_date": event_data["start_date"],
-                    "end_date": event_data["end_date"],
                 }
                 raw_events_by_month_and_region_writer.add_record_to_db_table(record)
-        for year in years_range:
-            for page in (
-                [g["page_title"] for (g, _) in where_geolocation if g]
-                + [c["page_title"] for (c, _) in city_geolocation if c]
-                + [event_data["page_title"]]
-                + event_data["people"]
-            ):
-                if page is None or page.endswith("(?)"):
-                    continue
-                record = {
-                    "page_title": page,
-                    "year": year,
-                    "event_id": event_data["event_id"],
-                }
+        page_ids = get_page_ids(
+            [g["page_title"] for (g, _) in where_geolocation if g]
+            + [c["page_title"] for (c, _) in city_geolocation if c]
+            + [page_title]
+            + people,
+            self.title_dictionary,
+        )
+        for year in dates.years_range:
+            for page_id in page_ids:
+                record = {"page_id": page_id, "year": year, "event_rowid": event_rowid}
                 raw_page_and_year_writer.add_record_to_db_table(record)
 
-        event_data["people"] = "|".join(event_data["people"])
-        event_data["geohash4"] = "|".join([g["geohash4"] for g, _ in geolocations])
-
-        event_sql_writer.add_record_to_db_table(event_data)
-
     def process_events_in_page(
         self,
         page_title,
         page_events,
-        counts,
         raw_events_by_month_and_region_writer,
         raw_page_and_year_writer,
         event_sql_writer,
-        date_errors,
-        no_location,
+        diagnostics,
     ):
-        zipped_page_links = self.page_links_db.get(page_title.encode())
-        page_links = json.loads(zlib.decompress(zipped_page_links).decode())
+        page_links = PageLinks(self.link_index_db, page_title)
         maybe_page_title_location = self.identify_place(
             page_title, page_links=page_links
         )
+        resolved_whens = resolve_whens(event["when"] for event in page_events)
 
         for i, event in enumerate(page_events):
             self.process_event(
@@ -275,12 +279,11 @@ class LLMEventProcessor:
                 event_index=i,
                 page_links=page_links,
                 maybe_page_title_location=maybe_page_title_location,
+                resolved_whens=resolved_whens,
                 raw_events_by_month_and_region_writer=raw_events_by_month_and_region_writer,
                 raw_page_and_year_writer=raw_page_and_year_writer,
                 event_sql_writer=event_sql_writer,
-                date_errors=date_errors,
-                no_location=no_location,
-                counts=counts,
+                diagnostics=diagnostics,
             )
 
 
@@ -301,16 +304,116 @@ def date_range_to_year_months(date_range):
     return result
 
 
+class ResolvedDates(NamedTuple):
+    """Everything the event processing needs to know about a "when" string."""
+
+    start_date: str
+    end_date: str
+    start_year: int
+    end_year: int
+    year_months: tuple
+
+    @property
+    def years_range(self):
+        return range(self.start_year, self.end_year + 1)
+
+
+class DateError(NamedTuple):
+    """The parsing error of an invalid "when" string (without its traceback)."""
+
+    message: str
+
+
+def normalize_when(when):
+    """Normalize a "when" string so that trivially different spellings
+    (extra spaces, trailing newlines) share the same cache entry."""
+    return " ".join(when.split())
+
+
+def parse_when(when):
+    """Parse a "when" string, without the cache. Returns its ResolvedDates, or
+    a DateError if the date is invalid."""
+    # Errors are returned rather than raised so that lru_cache remembers them
+    # too: invalid "when" strings repeat as much as valid ones. Only their
+    # message is kept, not the exception and its traceback.
+    try:
+        date_range = date_utils.DateRange.from_parsed_string(normalize_when(when))
+        return ResolvedDates(
+            start_date=date_range.start.to_string(),
+            end_date=date_range.end.to_string(),
+            start_year=date_range.start.year,
+            end_year=date_range.end.year,
+            year_months=tuple(date_range_to_year_months(date_range)),
+        )
+    except Exception as e:
+        return DateError(f"{type(e).__name__}: {e}")
+
+
+@lru_cache(maxsize=500_000)
+def _resolve_normalized_when(when):
+    return parse_when(when)
+
+
+def resolve_when(when):
+    """Return the (cached) ResolvedDates of a "when" string such as "1944",
+    "1914/1918" or "June 1940". Raises a ValueError if the date is invalid.
+    """
+    result = _resolve_normalized_when(normalize_when(when))
+    if isinstance(result, DateError):
+        raise ValueError(f"Invalid date {when!r}: {result.message}")
+    return result
+
+
+def resolve_whens(whens, use_cache=True):
+    """Resolve a batch of "when" strings (e.g. all the events of a page).
+
+    Returns a dict {normalized_when: ResolvedDates or DateError}, with each
+    distinct string parsed only once. Use ``normalize_when`` to look up results.
+    With ``use_cache=False`` the strings are parsed again rather than looked up
+    in the cache of the previous batches.
+    """
+    resolve_fn = _resolve_normalized_when if use_cache else parse_when
+    results = {}
+    for when in whens:
+        normalized = normalize_when(when)
+        if normalized not in results:
+            results[normalized] = resolve_fn(normalized)
+    return results
+
+
+def when_cache_info():
+    """Return the hits/misses/size statistics of the "when" strings cache."""
+    return _resolve_normalized_when.cache_info()
+
+
+def clear_when_cache():
+    _resolve_normalized_when.cache_clear()
+
+
+def get_page_ids(page_titles, title_dictionary):
+    """Return the distinct IDs of the given pages. Unidentified people
+    ("Name (?)") and titles missing from the dictionary are left out."""
+    page_ids = []
+    for title in page_titles:
+        if title is None or title.endswith("(?)"):
+            continue
+        page_id = title_dictionary.get_id(title)
+        if page_id is not None and page_id not in page_ids:
+            page_ids.append(page_id)
+    return page_ids
+
+
 def process_infobox_event(
     event_data,
-    counts,
+    diagnostics,
     raw_events_by_month_and_region_writer,
     raw_page_and_year_writer,
     event_sql_writer,
+    title_dictionary,
 ):
-    counts["total_events"] += 1
+    diagnostics.increment("total_events")
     if event_data["date"].strip() == "":
-        counts["errored_events"] += 1
+        diagnostics.record_failure("empty_date", page=event_data["page_title"])
         return
     if not isinstance(event_data["place"], list):
         event_data["place"] = [event_data["place"]]
@@ -324,53 +427,42 @@ def process_infobox_event(
             "category": event_data["event_type"],
         }
     )
-    try:
-        date_range = date_utils.DateRange.from_parsed_string(event_data["when"])
-    except Exception as e:
-        raise (e)
-    event_data["start_date"] = date_range.start.to_string()
-    event_data["end_date"] = date_range.end.to_string()
+    dates = resolve_when(event_data["when"])
+    event_data["start_date"] = dates.start_date
+    event_data["end_date"] = dates.end_date
     event_data["where_page_title"] = "|".join(
         [place["page_title"] for place in event_data["place"]]
     )
     event_data["location"] = event_data["where_page_title"]
     geolocations = event_data["place"]
 
-    years_range = list(range(date_range.start.year, date_range.end.year + 1))
-    year_months = date_range_to_year_months(date_range)
+    people = event_data["people"]
+    event_data["people"] = "|".join(people)
+    event_data["geohash4"] = "|".join([g["geohash4"] for g in geolocations])
+
+    for field in "date", "event_type", "place", "event_category":
+        event_data.pop(field, None)
+
+    event_rowid = event_sql_writer.add_record_to_db_table(record=event_data)
 
-    for year, month in year_months:
+    for year, month in dates.year_months:
         for g in geolocations:
             if g is None:
                 continue
             record = {
                 "month_region": f"{year}-{month if month is not None else ''}-{g['geohash4'][0]}",
-                "event_id": event_data["event_id"],
+                "event_rowid": event_rowid,
                 "geohash4": g["geohash4"],
-                "start_date": event_data["start_date"],
-                "end_date": event_data["end_date"],
             }
             raw_events_by_month_and_region_writer.add_record_to_db_table(record)
 
-    for year in years_range:
-        for page in (
-            [g["page_title"] for g in geolocations if g]
-            + [event_data["page_title"]]
-            + event_data["people"]
-        ):
-            if page is None or page.endswith("(?)"):
-                continue
-            record = {
-                "page_title": page,
-                "year": year,
-                "event_id": event_data["event_id"],
-            }
+    page_ids = get_page_ids(
+        [g["page_title"] for g in geolocations if g]
+        + [event_data["page_title"]]
+        + people,
+        title_dictionary,
+    )
+    for year in dates.years_range:
+        for page_id in page_ids:
+            record = {"page_id": page_id, "year": year, "event_rowid": event_rowid}
             raw_page_and_year_writer.add_record_to_db_table(record)
-
-    event_data["people"] = "|".join(event_data["people"])
-    event_data["geohash4"] = "|".join([g["geohash4"] for g in geolocations])
-
-    for field in "date", "event_type", "place", "event_category":
-        event_data.pop(field, None)
-
-    event_sql_writer.add_record_to_db_table(record=event_data)
@@ -0,0 +1,60 @@
+import json
+import zlib
+
+from tqdm.auto import tqdm
+
+from .db_utils import LMDBReader, LMDBWriter
+
+# Sorts before any printable character, so the keys stay grouped by page.
+LINK_KEY_SEPARATOR = "\x1f"
+MAX_KEY_SIZE = 511  # LMDB's maximum key size
+
+
+def get_link_key(page_title, anchor):
+    return f"{page_title}{LINK_KEY_SEPARATOR}{anchor}".encode()
+
+
+def build_link_index(
+    page_links_db, target_db, batch_size=100_000, map_size=60_000_000_000
+):
+    """Decode the page links store once and write the link index to target_db.
+
+    Returns the number of links written and skipped (keys too long).
+    """
+    counts = {"links": 0, "skipped_links": 0}
+    with (
+        LMDBReader(page_links_db) as page_links,
+        LMDBWriter(target_db, map_size=map_size) as link_index,
+    ):
+        batch = []
+        for page_title, zipped_links in tqdm(page_links, desc="Indexing links"):
+            links = json.loads(zlib.decompress(zipped_links).decode())
+            for anchor in sorted(links):
+                key = get_link_key(page_title, anchor)
+                if len(key) > MAX_KEY_SIZE:
+                    counts["skipped_links"] += 1
+                    continue
+                batch.append((key, json.dumps(links[anchor]).encode()))
+                counts["links"] += 1
+            if len(batch) >= batch_size:
+                link_index.write_batch(batch)
+                batch = []
+        link_index.write_batch(batch)
+    return counts
+
+
+class PageLinks:
+    """Dict-like view of the links of one page, backed by the link index."""
+
+    def __init__(self, link_index_db, page_title):
+        self.link_index_db = link_index_db
+        self.page_title = page_title
+
+    def get(self, anchor, default=None):
+        key = get_link_key(self.page_title, anchor)
+        if len(key) > MAX_KEY_SIZE:
+            return default
+        result = self.link_index_db.get(key)
+        if result is None:
+            return default
+        return json.loads(result.decode())
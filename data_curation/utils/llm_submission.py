@@ -0,0 +1,406 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .db_utils import LMDBWriter
+
+
+class RateLimiter:
+    """Token-bucket limiter allowing ``rate`` units per ``period`` seconds.
+
+    Amounts larger than the bucket are allowed but wait for a full bucket,
+    so that a single large batch can't be blocked forever.
+    """
+
+    def __init__(self, rate, period=60.0):
+        self.rate = rate
+        self.period = period
+        self.available = rate
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available = min(
+            self.rate, self.available + elapsed * self.rate / self.period
+        )
+        self.last_update = now
+
+    async def acquire(self, amount=1):
+        async with self.lock:
+            needed = min(amount, self.rate)
+            self._refill()
+            while self.available < needed:
+                missing = needed - self.available
+                await asyncio.sleep(missing * self.period / self.rate)
+                self._refill()
+            self.available -= amount
+
+
+class SubmissionJournal:
+    """Append-only JSONL log of the batch submissions."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def log(self, **record):
+        record["time"] = round(time.time(), 3)
+        with self.path.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def read(self):
+        if not self.path.exists():
+            return []
+        with self.path.open() as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def summary(self, run=None):
+        """Return the totals of the given run, or of all the logged runs."""
+        summary = {
+            "batches_done": 0,
+            "batches_failed": 0,
+            "retries": 0,
+            "pages": 0,
+            "events": 0,
+            "failed_pages": 0,
+            "errored_pages": 0,
+            "usage": {},
+        }
+        for record in self.read():
+            if run is not None and record["run"] != run:
+                continue
+            if record["status"] == "done":
+                summary["batches_done"] += 1
+                summary["pages"] += record["n_pages"]
+                summary["events"] += record["n_events"]
+                summary["failed_pages"] += record["n_failed"]
+                summary["errored_pages"] += record["n_errored"]
+                for key, value in record["usage"].items():
+                    summary["usage"][key] = summary["usage"].get(key, 0) + value
+            elif record["status"] == "retry":
+                summary["retries"] += 1
+            elif record["status"] == "failed":
+                summary["batches_failed"] += 1
+        return summary
+
+
+def gemini_request_builder(model_settings=None):
+    """Return a build_request function making Gemini batch request lines."""
+    import os
+
+    from google import genai
+    from wiki_dump_extractor import llm_utils
+
+    if model_settings is None:
+        model_settings = {"temperature": 0, "top_p": 0.95}
+    client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+
+    def build_request(page):
+        request = llm_utils.PageEventExtractionRequest.from_page(
+            page=page, model_settings=model_settings
+        )
+        return request.to_jsonl_request(client)
+
+    return build_request
+
+
+def estimate_tokens(line):
+    """Rough token count of a request line (~4 characters per token)."""
+    return len(line) // 4
+
+
+async def submit_pages(
+    pages,
+    target_db_path,
+    submit_fn,
+    build_request,
+    work_dir,
+    batch_size=1000,
+    max_concurrent_batches=2,
+    max_requests_per_minute=None,
+    max_tokens_per_minute=None,
+    max_retries=3,
+    retry_delay=30,
+    journal_path=None,
+    map_size=30_000_000_000,
+):
+    """Submit the pages missing from the target LMDB store, by batches.
+
+    ``submit_fn(jsonl_path, batch_name)`` is an async function returning
+    ``(results_by_page, failed, errored, usage)``, and ``build_request`` turns
+    a page into a request line. Events, failed and errored responses are all
+    written to the store so these pages aren't submitted again. Failed batches
+    (after ``max_retries``) are only logged in the journal, and their pages are
+    submitted again by the next run. Returns the journal's summary of the run.
+    """
+    if (Path(target_db_path) / "CURRENT").exists():
+        # LMDB would create its files next to the LevelDB ones, and wouldn't
+        # see the pages already processed.
+        raise ValueError(f"{target_db_path} is a LevelDB store, convert it first")
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    journal = SubmissionJournal(journal_path or work_dir / "journal.jsonl")
+    run_id = str(int(time.time() * 1000))
+    semaphore = asyncio.Semaphore(max_concurrent_batches)
+    requests_limiter = tokens_limiter = None
+    if max_requests_per_minute is not None:
+        requests_limiter = RateLimiter(max_requests_per_minute)
+    if max_tokens_per_minute is not None:
+        tokens_limiter = RateLimiter(max_tokens_per_minute)
+
+    with LMDBWriter(target_db_path, map_size=map_size) as target_db:
+
+        def write_results(results_by_page, failed, errored):
+            records = []
+            for page_title, data in failed.items():
+                records.append((page_title.encode(), json.dumps(data).encode()))
+            for page_title, error in errored.items():
+                records.append((page_title.encode(), error.encode()))
+            for page_title, events in results_by_page.items():
+                records.append((page_title.encode(), json.dumps(events).encode()))
+            target_db.write_batch(records)
+
+        async def process_batch(batch_name, jsonl_path, titles, n_tokens):
+            n_pages = len(titles)
+            try:
+                if requests_limiter:
+                    await requests_limiter.acquire(n_pages)
+                if tokens_limiter:
+                    await tokens_limiter.acquire(n_tokens)
+                for attempt in range(max_retries + 1):
+                    start_time = time.time()
+                    try:
+                        results = await submit_fn(jsonl_path, batch_name)
+                        break
+                    except Exception as error:
+                        status = "retry" if attempt < max_retries else "failed"
+                        journal.log(
+                            run=run_id,
+                            batch=batch_name,
+                            status=status,
+                            attempt=attempt,
+                            error=repr(error),
+                        )
+                        if status == "failed":
+                            return
+                        await asyncio.sleep(retry_delay * 2**attempt)
+                results_by_page, failed, errored, usage = results
+                write_results(results_by_page, failed, errored)
+                journal.log(
+                    run=run_id,
+                    batch=batch_name,
+                    status="done",
+                    attempt=attempt,
+                    seconds=round(time.time() - start_time, 2),
+                    n_pages=n_pages,
+                    n_tokens_estimate=n_tokens,
+                    n_events=sum(len(e) for e in results_by_page.values()),
+                    n_failed=len(failed),
+                    n_errored=len(errored),
+                    usage=usage,
+                )
+            finally:
+                jsonl_path.unlink(missing_ok=True)
+                in_flight_titles.difference_update(titles)
+                semaphore.release()
+
+        tasks = []
+        batch_file = None
+        # Titles of the batches not yet written to the target store (the
+        # others are found in the store).
+        in_flight_titles = set()
+        try:
+            for page in pages:
+                title = page.title
+                if title in in_flight_titles or target_db.get(title.encode()):
+                    continue
+                if batch_file is None:
+                    # Wait for a slot before writing a new batch file to disk.
+                    await semaphore.acquire()
+                    batch_name = f"batch_{run_id}_{len(tasks)}"
+                    jsonl_path = work_dir / f"{batch_name}.jsonl"
+                    batch_file = jsonl_path.open("w")
+                    titles, n_tokens = [], 0
+                line = json.dumps(build_request(page))
+                batch_file.write(line + "\n")
+                titles.append(title)
+                in_flight_titles.add(title)
+                n_tokens += estimate_tokens(line)
+                if len(titles) == batch_size:
+                    batch_file.close()
+                    batch_file = None
+                    tasks.append(
+                        asyncio.create_task(
+                            process_batch(batch_name, jsonl_path, titles, n_tokens)
+                        )
+                    )
+                # Let the running batches progress while pages are being read.
+                await asyncio.sleep(0)
+            if batch_file is not None:
+                batch_file.close()
+                batch_file = None
+                tasks.append(
+                    asyncio.create_task(
+                        process_batch(batch_name, jsonl_path, titles, n_tokens)
+                    )
+                )
+            await asyncio.gather(*tasks)
+        finally:
+            # On errors (reading the pages, building a request...), the
+            # submitted batches are awaited so their results are written
+            # before the target store is closed.
+            if batch_file is not None:
+                batch_file.close()
+                jsonl_path.unlink()
+                semaphore.release()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return journal.summary(run=run_id)
+
+
+def parse_predictions_jsonl(lines):
+    """Parse batch prediction lines (Vertex AI format) into
+    ``(results_by_page, failed, errored, usage)``."""
+    results_by_page, failed, errored, usage = {}, {}, {}, {}
+    for line in lines:
+        if not line.strip():
+            continue
+        page_results = json.loads(line)
+        page_title = page_results["page_title"]
+        try:
+            response = page_results["response"]
+            for key, value in response.get("usageMetadata", {}).items():
+                if isinstance(value, int):
+                    usage[key] = usage.get(key, 0) + value
+            candidate = response["candidates"][0]
+            if candidate["finishReason"] != "STOP":
+                failed[page_title] = page_results
+                continue
+            json_response = candidate["content"]["parts"][0]["text"]
+            results_by_page[page_title] = json.loads(json_response)["events"]
+        except Exception as e:
+            errored[page_title] = str(e)
+    return results_by_page, failed, errored, usage
+
+
+class MockBatchServer:
+    """Local HTTP server imitating a batch prediction endpoint.
+
+    POSTing a JSONL file of requests to ``/batch`` returns a JSONL file of
+    predictions in the Vertex AI format, with one fake event per page. The
+    server waits ``latency + seconds_per_request * n_requests`` seconds before
+    answering, and fails whole batches (HTTP 503) with probability
+    ``batch_failure_rate``, to test the throughput, retries and resuming of
+    ``submit_pages``.
+    """
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.1,
+        seconds_per_request=0.0,
+        batch_failure_rate=0.0,
+        page_failure_rate=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.seconds_per_request = seconds_per_request
+        self.batch_failure_rate = batch_failure_rate
+        self.page_failure_rate = page_failure_rate
+        self.random = random.Random(seed)
+        self.n_batches_received = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                content_length = int(self.headers["Content-Length"])
+                lines = self.rfile.read(content_length).decode().splitlines()
+                status, body = server.respond(lines)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/jsonl")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/batch"
+
+    def respond(self, lines):
+        self.n_batches_received += 1
+        time.sleep(self.latency + self.seconds_per_request * len(lines))
+        if self.random.random() < self.batch_failure_rate:
+            return 503, b"Batch failed"
+        predictions = []
+        for line in lines:
+            request = json.loads(line)
+            n_prompt_tokens = estimate_tokens(line)
+            if self.random.random() < self.page_failure_rate:
+                finish_reason, text = "MAX_TOKENS", ""
+            else:
+                finish_reason = "STOP"
+                event = {
+                    "who": "",
+                    "what": f"Something happened in {request['page_title']}",
+                    "where": request["page_title"],
+                    "city": "",
+                    "when": "1900",
+                }
+                text = json.dumps({"events": [event]})
+            response = {
+                "usageMetadata": {
+                    "promptTokenCount": n_prompt_tokens,
+                    "candidatesTokenCount": estimate_tokens(text),
+                },
+                "candidates": [
+                    {
+                        "finishReason": finish_reason,
+                        "content": {"parts": [{"text": text}]},
+                    }
+                ],
+            }
+            predictions.append(
+                json.dumps({"page_title": request["page_title"], "response": response})
+            )
+        return 200, "\n".join(predictions).encode()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def mock_submit_fn(url):
+    """Return a submit_fn sending the batches to a MockBatchServer."""
+
+    def post_batch(jsonl_path):
+        data = Path(jsonl_path).read_bytes()
+        request = urllib.request.Request(url, data=data, method="POST")
+        with urllib.request.urlopen(request) as response:
+            return response.read().decode().splitlines()
+
+    async def submit_fn(jsonl_path, batch_name):
+        lines = await asyncio.to_thread(post_batch, jsonl_path)
+        return parse_predictions_jsonl(lines)
+
+    return submit_fn
+
+
+def mock_request_builder(page):
+    """Build a minimal request line, for use with the MockBatchServer."""
+    return {
+        "page_title": page.title,
+        "request": {"contents": [{"role": "user", "parts": [{"text": page.text}]}]},
+    }
@@ -0,0 +1,270 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+
+class Stage:
+    def __init__(
+        self,
+        name,
+        fn,
+        inputs=(),
+        outputs=(),
+        kwargs=None,
+        n_cores=1,
+        only_if_missing=False,
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.kwargs = kwargs or {}
+        self.n_cores = n_cores
+        self.only_if_missing = only_if_missing
+
+
+def _is_within(path, parent):
+    return path == parent or parent in path.parents
+
+
+def fingerprint_path(path, content_hash_max_size=100_000_000):
+    """Return a hash of a file or directory (recursively)."""
+    path = Path(path)
+    hasher = hashlib.sha256()
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    else:
+        files = [path]
+    for file in files:
+        if file.name == "lock.mdb":  # Modified by LMDB readers.
+            continue
+        stat = file.stat()
+        hasher.update(str(file.relative_to(path.parent)).encode())
+        if stat.st_size <= content_hash_max_size:
+            hasher.update(file.read_bytes())
+        else:
+            hasher.update(f"{stat.st_size}-{stat.st_mtime_ns}".encode())
+    return hasher.hexdigest()
+
+
+def _get_source(fn):
+    try:
+        return inspect.getsource(fn)
+    except (OSError, TypeError):
+        return f"{fn.__module__}.{fn.__qualname__}"
+
+
+def _run_stage(fn, kwargs):
+    start_time = time.time()
+    fn(**kwargs)
+    return time.time() - start_time
+
+
+class Pipeline:
+    """A DAG of stages with a core budget. Stages whose outputs exist and
+    whose inputs, source and arguments haven't changed are skipped."""
+
+    def __init__(self, state_path, n_cores=None, content_hash_max_size=100_000_000):
+        self.state_path = Path(state_path)
+        self.n_cores = n_cores or os.cpu_count()
+        self.content_hash_max_size = content_hash_max_size
+        self.stages = {}
+
+    def add_stage(
+        self,
+        name,
+        fn,
+        inputs=(),
+        outputs=(),
+        kwargs=None,
+        n_cores=1,
+        only_if_missing=False,
+    ):
+        """Add a stage. Stages with ``only_if_missing`` (e.g. the extraction of
+        the dump, which takes hours) only run when their outputs are missing,
+        and their inputs and arguments aren't hashed."""
+        stage = Stage(
+            name,
+            fn,
+            inputs,
+            outputs,
+            kwargs=kwargs,
+            n_cores=n_cores,
+            only_if_missing=only_if_missing,
+        )
+        for other in self.stages.values():
+            for output in stage.outputs:
+                if any(
+                    _is_within(output, o) or _is_within(o, output)
+                    for o in other.outputs
+                ):
+                    raise ValueError(f"{output} is already an output of {other.name}")
+        self.stages[name] = stage
+        return stage
+
+    def dependencies(self, stage):
+        return [
+            other.name
+            for other in self.stages.values()
+            if other is not stage
+            and any(_is_within(i, o) for i in stage.inputs for o in other.outputs)
+        ]
+
+    def _sorted_stages(self, targets=None):
+        """Return the stage names (restricted to the targets and their
+        upstream stages) in topological order."""
+        dependencies = {name: self.dependencies(s) for name, s in self.stages.items()}
+        result, visiting = [], set()
+
+        def visit(name):
+            if name in result:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself")
+            visiting.add(name)
+            for dependency in dependencies[name]:
+                visit(dependency)
+            visiting.discard(name)
+            result.append(name)
+
+        for name in targets or self.stages:
+            visit(name)
+        return result, dependencies
+
+    def inputs_hash(self, stage):
+        if stage.only_if_missing:
+            return None
+        hasher = hashlib.sha256(_get_source(stage.fn).encode())
+        for key, value in sorted(stage.kwargs.items()):
+            # Functions passed as arguments are hashed by their source too.
+            value = _get_source(value) if callable(value) else repr(value)
+            hasher.update(f"{key}={value}".encode())
+        for path in stage.inputs:
+            if not path.exists():
+                raise FileNotFoundError(f"Input {path} of {stage.name} is missing")
+            hasher.update(fingerprint_path(path, self.content_hash_max_size).encode())
+        return hasher.hexdigest()
+
+    def _load_state(self):
+        if self.state_path.exists():
+            return json.loads(self.state_path.read_text())
+        return {}
+
+    def _save_state(self, state):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.state_path.write_text(json.dumps(state, indent=2))
+
+    def _cached_status(self, stage, inputs_hash, state, adopt=False):
+        """Return "skipped" or "adopted" if the stage needn't run, else None.
+
+        Outputs of a stage which started but never finished (marked "running"
+        in the state) are partial and never reused. Outputs never recorded by
+        the pipeline are only reused (adopted) if ``adopt`` is True.
+        """
+        if not all(path.exists() for path in stage.outputs):
+            return None
+        previous = state.get(stage.name)
+        if previous is None:
+            if not (adopt or stage.only_if_missing):
+                return None
+            warnings.warn(
+                f"Adopting the existing outputs of {stage.name}, which weren't "
+                "produced by the pipeline: "
+                + ", ".join(str(path) for path in stage.outputs)
+            )
+            return "adopted"
+        if previous.get("running"):
+            return None
+        if stage.only_if_missing or previous["inputs_hash"] == inputs_hash:
+            return "skipped"
+        return None
+
+    def run(self, targets=None, force=(), adopt=False):
+        """Run the given target stages (default: all) and their upstream stages.
+
+        Stages in ``force`` are rerun even if up to date. Existing outputs not
+        produced by the pipeline (e.g. by the notebooks) are rebuilt, unless
+        ``adopt`` is True. Returns a list of dicts (stage, status, seconds) in
+        the order the stages finished, with status one of "done", "skipped",
+        "adopted".
+        """
+        order, dependencies = self._sorted_stages(targets)
+        state = self._load_state()
+        report = []
+        finished, inputs_hashes = set(), {}
+        running = {}  # future -> (stage, inputs_hash)
+
+        def finish(stage, inputs_hash, status, seconds=0):
+            previous = state.get(stage.name, {})
+            state[stage.name] = {
+                "inputs_hash": inputs_hash,
+                "seconds": previous.get("seconds"),
+            }
+            finished.add(stage.name)
+            if status == "done":
+                state[stage.name]["seconds"] = round(seconds, 1)
+            self._save_state(state)
+            report.append({"stage": stage.name, "status": status, "seconds": seconds})
+
+        with ProcessPoolExecutor(max_workers=self.n_cores) as executor:
+            while len(finished) < len(order):
+                for name in order:
+                    stage = self.stages[name]
+                    is_running = any(s is stage for s, _ in running.values())
+                    if name in finished or is_running:
+                        continue
+                    if not all(d in finished for d in dependencies[name]):
+                        continue
+                    if name not in inputs_hashes:
+                        inputs_hashes[name] = self.inputs_hash(stage)
+                    inputs_hash = inputs_hashes[name]
+                    status = self._cached_status(stage, inputs_hash, state, adopt)
+                    if status is not None and name not in force:
+                        finish(stage, inputs_hash, status)
+                        continue
+                    cores_in_use = sum(s.n_cores for s, _ in running.values())
+                    if running and cores_in_use + stage.n_cores > self.n_cores:
+                        continue
+                    # Mark the stage as running before touching its outputs, so
+                    # an interrupted run never leaves outputs looking finished.
+                    state[name] = {"running": True}
+                    self._save_state(state)
+                    _remove_outputs(stage)
+                    future = executor.submit(_run_stage, stage.fn, stage.kwargs)
+                    running[future] = (stage, inputs_hash)
+                if len(finished) == len(order):
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, inputs_hash = running.pop(future)
+                    if future.exception() is not None:
+                        for other in running:
+                            other.cancel()
+                        _remove_outputs(stage)
+                        raise future.exception()
+                    finish(stage, inputs_hash, "done", future.result())
+        return report
+
+
+def _remove_outputs(stage):
+    for path in stage.outputs:
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+
+def format_report(report):
+    lines = [f"{'stage':<30} {'status':<8} {'time':>10}"]
+    for entry in report:
+        lines.append(
+            f"{entry['stage']:<30} {entry['status']:<8} {entry['seconds']:>9.1f}s"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+import multiprocessing
+from collections import defaultdict
+
+import fastavro
+from tqdm.auto import tqdm
+from wiki_dump_extractor import page_utils
+
+from .db_utils import LMDBReader
+
+
+def clean_text(text):
+    text = page_utils.remove_appendix_sections(text)
+    text = page_utils.replace_titles_with_section_headers(text)
+    text = page_utils.remove_comments_and_citations(text)
+    return text
+
+
+def _clean_text_lengths(titles_and_texts):
+    return [(title, len(clean_text(text or ""))) for title, text in titles_and_texts]
+
+
+def group_titles_by_block(page_index_db, titles):
+    """Return {block_offset: set of titles} for the titles found in the index
+    (and the list of titles not found)."""
+    titles_by_block = defaultdict(set)
+    missing_titles = []
+    with LMDBReader(page_index_db) as page_index:
+        for title in titles:
+            offset = page_index.get(title.encode())
+            if offset is None:
+                missing_titles.append(title)
+            else:
+                titles_by_block[int(offset.decode())].add(title)
+    return titles_by_block, missing_titles
+
+
+def iter_pages_in_dump_order(avro_dump_path, page_index_db, titles):
+    """Yield the (title, text) of the given pages, in the order of the dump.
+
+    Titles which are not in the index are ignored.
+    """
+    titles_by_block, _ = group_titles_by_block(page_index_db, titles)
+    with open(avro_dump_path, "rb") as f:
+        reader = fastavro.reader(f)
+        # The index stores, for each page, the position of the reader before
+        # the block of the page was read: the end of the header for the first
+        # block, else the sync marker ending the previous block. Seeking to a
+        # sync marker only works once the reader has started reading records.
+        header_end = f.tell()
+        is_started = False
+        for offset in sorted(titles_by_block):
+            remaining_titles = titles_by_block[offset]
+            if offset != header_end:
+                if not is_started:
+                    next(reader)
+                f.seek(offset)
+            is_started = True
+            for record in reader:
+                if record["title"] in remaining_titles:
+                    remaining_titles.discard(record["title"])
+                    yield record["title"], record["text"]
+                    if not remaining_titles:
+                        break
+
+
+def _iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def compute_clean_page_lengths(
+    avro_dump_path, page_index_db, titles, num_workers=6, batch_size=500
+):
+    """Return {title: length of the cleaned page text} for the given titles.
+
+    Pages are read in dump order by this process and cleaned by
+    ``num_workers`` processes.
+    """
+    titles = set(titles)
+    pages = iter_pages_in_dump_order(avro_dump_path, page_index_db, titles)
+    length_by_page = {}
+    with multiprocessing.Pool(num_workers) as pool:
+        batches = pool.imap_unordered(
+            _clean_text_lengths, _iter_batches(pages, batch_size)
+        )
+        with tqdm(total=len(titles), desc="Cleaning pages") as progress_bar:
+            for batch_lengths in batches:
+                length_by_page.update(batch_lengths)
+                progress_bar.update(len(batch_lengths))
+    return length_by_page
+
+
+def score_places(places_df, length_by_page):
+    """Add the true_page_len and score columns to the places dataframe (in place).
+
+    The score is the cleaned length of the page divided by the number of
+    places of the page.
+    """
+    places_df["true_page_len"] = places_df["page_title"].map(length_by_page)
+    page_occurrences = places_df.groupby("page_title")["page_title"].transform("size")
+    places_df["score"] = places_df["true_page_len"] / page_occurrences
+    return places_df
+
+
+def deduplicate_places(places_df):
+    """Keep one place per geohash4 (cities first, then the highest score) and
+    return the places sorted by decreasing score."""
+    places_df = places_df.sort_values(["is_city", "score"], ascending=False)
+    places_df = places_df.drop_duplicates(subset=["geohash4"])
+    return places_df.sort_values("score", ascending=False)
+
+
+def rank_places(places_df, length_by_page, city_names):
+    """Mark the cities, score and deduplicate the places."""
+    places_df["is_city"] = places_df["page_title"].str.lower().isin(city_names)
+    score_places(places_df, length_by_page)
+    return deduplicate_places(places_df)
@@ -0,0 +1,216 @@
+import gzip
+import json
+import shutil
+import sqlite3
+import time
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+from tqdm.auto import tqdm
+
+TILES_FORMAT_VERSION = 2
+
+
+def get_places_tile_prefix(geokey, tile_depth=3):
+    return geokey[: max(1, len(geokey) - tile_depth)]
+
+
+def _write_tile(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # mtime=0 so that unchanged tiles keep the same bytes (and ETag) on rebuilds.
+    content = gzip.compress(json.dumps(data, separators=(",", ":")).encode(), mtime=0)
+    path.write_bytes(content)
+    return len(content)
+
+
+def _write_index(path, tiles):
+    path.write_text(json.dumps(sorted(tiles)))
+    return path.stat().st_size
+
+
+def _read_blob(blob, unloaded_files_dir=None):
+    """Return the decompressed JSON of a zlib blob, fetching it from the
+    unloading directory if it was unloaded by SqliteTableBatchWriter."""
+    if blob.startswith(b"file:"):
+        filename = Path(blob[len(b"file:") :].decode()).name
+        blob = (Path(unloaded_files_dir) / filename).read_bytes()
+    return json.loads(zlib.decompress(blob).decode())
+
+
+def export_places_tiles(places_db_path, output_dir, tile_depth=3):
+    """Write the tiles of the places table of places.sqlite to output_dir/places.
+
+    There is one directory per zoom level (geokey length), and one tile per
+    geokey prefix ``tile_depth`` characters shorter than the geokeys. Returns
+    a dict of statistics (number of files, total bytes).
+    """
+    output_dir = Path(output_dir) / "places"
+    conn = sqlite3.connect(places_db_path)
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT geokey, geokey_complement, category, name, dots, page_title "
+        "FROM places ORDER BY geokey"
+    )
+    places_by_tile = defaultdict(list)
+    for geokey, complement, category, name, dots, page_title in tqdm(
+        cur, desc="Places"
+    ):
+        place = {
+            "geokey": geokey,
+            "geokey_complement": complement,
+            "category": category,
+            "name": name,
+            "page_title": page_title,
+        }
+        if dots:
+            place["dots"] = json.loads(zlib.decompress(dots).decode())
+        zoom = len(geokey)
+        places_by_tile[(zoom, get_places_tile_prefix(geokey, tile_depth))].append(place)
+    conn.close()
+
+    stats = {"n_files": 0, "total_bytes": 0}
+    prefixes_by_zoom = defaultdict(list)
+    for (zoom, prefix), places in places_by_tile.items():
+        path = output_dir / str(zoom) / f"{prefix}.json.gz"
+        stats["total_bytes"] += _write_tile(path, places)
+        stats["n_files"] += 1
+        prefixes_by_zoom[zoom].append(prefix)
+    for zoom, prefixes in prefixes_by_zoom.items():
+        index_path = output_dir / str(zoom) / "index.json"
+        stats["total_bytes"] += _write_index(index_path, prefixes)
+        stats["n_files"] += 1
+    return stats
+
+
+def sample_events(events, max_events):
+    """Return at most max_events events, taken in turn from each geohash4 cell
+    so that the sample covers the whole tile."""
+    if len(events) <= max_events:
+        return events
+    events_by_cell = defaultdict(list)
+    for event in events:
+        events_by_cell[event["geohash4"]].append(event)
+    cells = [events_by_cell[cell] for cell in sorted(events_by_cell)]
+    sample = []
+    for rank in range(len(events)):
+        for cell_events in cells:
+            if rank < len(cell_events):
+                sample.append(cell_events[rank])
+                if len(sample) == max_events:
+                    return sample
+
+
+def iter_events_tiles(events, prefix, max_zoom=4, max_events_per_tile=500):
+    """Yield the (prefix, tile) of the pyramid of the events whose geohash
+    starts with prefix.
+
+    Each tile has at most max_events_per_tile events (except at max_zoom) and
+    the total number of events of its prefix. Only the tiles where events
+    were left out have tiles at the next zoom level (one more character).
+    """
+    is_complete = len(events) <= max_events_per_tile or len(prefix) >= max_zoom
+    tile_events = events if is_complete else sample_events(events, max_events_per_tile)
+    yield prefix, {"events": tile_events, "n_events": len(events)}
+    if is_complete:
+        return
+    events_by_child = defaultdict(list)
+    for event in events:
+        events_by_child[event["geohash4"][: len(prefix) + 1]].append(event)
+    for child in sorted(events_by_child):
+        yield from iter_events_tiles(
+            events_by_child[child], child, max_zoom, max_events_per_tile
+        )
+
+
+def export_events_tiles(
+    events_by_month_region_db_path,
+    output_dir,
+    max_zoom=4,
+    max_events_per_tile=500,
+    unloaded_files_dir=None,
+):
+    """Write the pyramid of tiles of the events_by_month_region table to
+    output_dir/events, one pyramid per month_region (see ``iter_events_tiles``).
+
+    The zoom level of a tile is the length of its geohash prefix, the tiles of
+    zoom 1 covering a whole month_region. ``unloaded_files_dir`` is the
+    directory of the blobs unloaded to files because they were too large for
+    the database. Returns a dict of statistics (number of files, total bytes).
+    """
+    output_dir = Path(output_dir) / "events"
+    conn = sqlite3.connect(events_by_month_region_db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT month_region, zlib_json_blob FROM events_by_month_region")
+
+    stats = {"n_files": 0, "total_bytes": 0, "n_tiles_by_zoom": defaultdict(int)}
+    tiles_by_year = defaultdict(list)
+    for month_region, blob in tqdm(cur, desc="Month regions"):
+        year, month, region = month_region.rsplit("-", 2)
+        month = month or "full_year"
+        events = _read_blob(blob, unloaded_files_dir)
+        tiles = iter_events_tiles(events, region, max_zoom, max_events_per_tile)
+        for prefix, tile in tiles:
+            zoom = len(prefix)
+            path = output_dir / year / month / str(zoom) / f"{prefix}.json.gz"
+            stats["total_bytes"] += _write_tile(path, tile)
+            stats["n_files"] += 1
+            stats["n_tiles_by_zoom"][zoom] += 1
+            tiles_by_year[year].append(f"{month}/{zoom}/{prefix}")
+    conn.close()
+    for year, tiles in tiles_by_year.items():
+        stats["total_bytes"] += _write_index(output_dir / year / "index.json", tiles)
+        stats["n_files"] += 1
+    stats["n_tiles_by_zoom"] = dict(sorted(stats["n_tiles_by_zoom"].items()))
+    return stats
+
+
+def export_static_tiles(
+    output_dir,
+    places_db_path=None,
+    events_by_month_region_db_path=None,
+    tile_depth=3,
+    events_max_zoom=4,
+    events_max_events_per_tile=500,
+    unloaded_files_dir=None,
+):
+    """Export the places and/or events tiles to output_dir, with a manifest.
+
+    The output directory is replaced. Returns the manifest, which includes the
+    build time and total size of each part for comparison with the SQL export.
+    """
+    output_dir = Path(output_dir)
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True)
+    manifest = {"version": TILES_FORMAT_VERSION}
+
+    if places_db_path is not None:
+        start_time = time.time()
+        stats = export_places_tiles(places_db_path, output_dir, tile_depth=tile_depth)
+        stats["build_seconds"] = round(time.time() - start_time, 1)
+        manifest["places"] = {
+            "path": "places/{zoom}/{prefix}.json.gz",
+            "tile_depth": tile_depth,
+            **stats,
+        }
+
+    if events_by_month_region_db_path is not None:
+        start_time = time.time()
+        stats = export_events_tiles(
+            events_by_month_region_db_path,
+            output_dir,
+            max_zoom=events_max_zoom,
+            max_events_per_tile=events_max_events_per_tile,
+            unloaded_files_dir=unloaded_files_dir,
+        )
+        stats["build_seconds"] = round(time.time() - start_time, 1)
+        manifest["events"] = {
+            "path": "events/{year}/{month}/{zoom}/{prefix}.json.gz",
+            "max_zoom": events_max_zoom,
+            "max_events_per_tile": events_max_events_per_tile,
+            **stats,
+        }
+
+    (output_dir / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
@@ -0,0 +1,120 @@
+from array import array
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from .db_utils import LMDBReader
+
+
+def write_sorted_strings(strings, target_dir, name):
+    """Write an iterable of strings, already sorted by their utf-8 bytes, as
+    ``{name}s.bin`` (all strings concatenated) and ``{name}_offsets.npy``."""
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    offsets = array("q", [0])
+    with open(target_dir / f"{name}s.bin", "wb") as f:
+        for string in strings:
+            encoded = string.encode()
+            f.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    np.save(target_dir / f"{name}_offsets.npy", np.frombuffer(offsets, np.int64))
+
+
+class SortedStrings:
+    """Memory-mapped list of sorted strings written by ``write_sorted_strings``.
+
+    ``strings[i]`` returns the i-th string and ``strings.index(s)`` finds the
+    position of a string by binary search (or returns None).
+    """
+
+    def __init__(self, source_dir, name):
+        source_dir = Path(source_dir)
+        self.offsets = np.load(source_dir / f"{name}_offsets.npy", mmap_mode="r")
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap(source_dir / f"{name}s.bin", mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)  # numpy can't map empty files
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _get_bytes(self, position):
+        return self.blob[self.offsets[position] : self.offsets[position + 1]].tobytes()
+
+    def __getitem__(self, position):
+        return self._get_bytes(position).decode()
+
+    def index(self, string):
+        encoded = string.encode()
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_bytes(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._get_bytes(low) == encoded:
+            return low
+        return None
+
+
+def build_title_dictionary(page_index_db, redirects_db, target_dir):
+    """Write the title dictionary of the pages in the dump to target_dir.
+
+    Both LMDB stores are read in key order, which is the utf-8 bytes order of
+    the titles, so no sorting is needed.
+    """
+    with LMDBReader(page_index_db) as page_index:
+        keys = (key for key, _ in page_index)
+        write_sorted_strings(tqdm(keys, desc="Page titles"), target_dir, "title")
+    titles = SortedStrings(target_dir, "title")
+
+    redirect_targets = array("I")
+
+    def iter_redirects():
+        with LMDBReader(redirects_db) as redirects:
+            for redirect, target in tqdm(redirects, desc="Redirects"):
+                target_id = titles.index(target.decode())
+                if target_id is not None:
+                    redirect_targets.append(target_id)
+                    yield redirect
+
+    write_sorted_strings(iter_redirects(), target_dir, "redirect")
+    np.save(
+        Path(target_dir) / "redirect_targets.npy",
+        np.frombuffer(redirect_targets, dtype=np.uint32),
+    )
+    return TitleDictionary(target_dir)
+
+
+class TitleDictionary:
+    """Map page titles to dense integer IDs and back. Redirect titles get the
+    ID of the page they redirect to."""
+
+    def __init__(self, source_dir):
+        self.titles = SortedStrings(source_dir, "title")
+        self.redirects = SortedStrings(source_dir, "redirect")
+        self.redirect_targets = np.load(
+            Path(source_dir) / "redirect_targets.npy", mmap_mode="r"
+        )
+        # Cached per instance: an lru_cache on the method would be shared by
+        # all the instances and keep them alive.
+        self.get_id = lru_cache(maxsize=100_000)(self._get_id)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _get_id(self, title):
+        """Return the ID of a page or redirect title, or None if unknown."""
+        page_id = self.titles.index(title)
+        if page_id is not None:
+            return page_id
+        redirect_position = self.redirects.index(title)
+        if redirect_position is not None:
+            return int(self.redirect_targets[redirect_position])
+        return None
+
+    def get_title(self, page_id):
+        return self.titles[page_id]